@@ -1,145 +1,411 @@
 import azure.functions as func
 import logging
-import json
+import orjson
+import ijson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 import gspread
-import gspread_dataframe as gd
+from gspread.utils import absolute_range_name
 import time
 import re
+import functools
+import queue
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
-# Load credentials for Shopify and Google Sheets
+# Columns of the Combined_Customers_Orders report
+REQUIRED_COLUMNS = [
+    # Orders Details
+    'orders_id',
+    'orders_cancel_reason',
+    'orders_cancelled_at',
+    'orders_estimated_taxes',
+    'orders_fulfillment_status',
+    'orders_updated_at',
+    'orders_item_type',
+    'orders_item_id',
+    'orders_item_title',
+    'orders_item_quantity',
+    'orders_item_price',
+
+    # Orders Shipping Address
+    'orders_shipping_address_first_name',
+    'orders_shipping_address_last_name',
+    'orders_shipping_address_address1',
+    'orders_shipping_address_address2',
+    'orders_shipping_address_city',
+    'orders_shipping_address_province',
+    'orders_shipping_address_country',
+    'orders_shipping_address_zip',
+    'orders_shipping_address_phone',
+    'orders_shipping_address_company',
+    'orders_shipping_address_name',
+    'orders_shipping_address_country_code',
+    'orders_shipping_address_province_code',
+    'orders_shipping_address_latitude',
+    'orders_shipping_address_longitude',
+
+    # Orders Billing Address
+    'orders_billing_address_first_name',
+    'orders_billing_address_last_name',
+    'orders_billing_address_address1',
+    'orders_billing_address_address2',
+    'orders_billing_address_city',
+    'orders_billing_address_province',
+    'orders_billing_address_country',
+    'orders_billing_address_zip',
+    'orders_billing_address_phone',
+    'orders_billing_address_company',
+    'orders_billing_address_name',
+    'orders_billing_address_country_code',
+    'orders_billing_address_province_code',
+    'orders_billing_address_latitude',
+    'orders_billing_address_longitude',
+
+    # Orders Customer Default Address
+    'orders_customer_default_address_id',
+    'orders_customer_default_address_customer_id',
+    'orders_customer_default_address_first_name',
+    'orders_customer_default_address_last_name',
+    'orders_customer_default_address_company',
+    'orders_customer_default_address_address1',
+    'orders_customer_default_address_address2',
+    'orders_customer_default_address_city',
+    'orders_customer_default_address_province',
+    'orders_customer_default_address_country',
+    'orders_customer_default_address_zip',
+    'orders_customer_default_address_phone',
+    'orders_customer_default_address_name',
+    'orders_customer_default_address_province_code',
+    'orders_customer_default_address_country_code',
+    'orders_customer_default_address_country_name',
+    'orders_customer_default_address_default',
+
+    # Orders Refunds
+    'orders_refunds_0_transactions_0_created_at',
+    'orders_refunds_0_refund_line_items_0_line_item_fulfillment_service',
+
+    # Customers
+    'customers_email',
+    'customers_firstName',
+    'customers_lastName',
+    'customers_shop_name',
+    'customers_vat_number',
+    'customers_shipping_address_id',
+    'customers_billing_address_id',
+    'customers_sales_manager',
+
+    # Orders Shop
+    'orders_shop_name',
+
+    # Orders Customer
+    'orders_customer_verified_email',
+    'orders_customer_email_marketing_consent_state',
+    'orders_customer_currency',
+]
+
+# Report columns taken from each side of the orders/customers join
+ORDER_REPORT_COLUMNS = [column for column in REQUIRED_COLUMNS if column.startswith('orders_')]
+CUSTOMER_REPORT_COLUMNS = [column for column in REQUIRED_COLUMNS if column.startswith('customers_')]
+
+# Scalar order fields shown on the per-store and Orders_all tabs besides the report's columns
+ORDER_DETAIL_FIELDS = [
+    'name',
+    'order_number',
+    'email',
+    'created_at',
+    'processed_at',
+    'currency',
+    'financial_status',
+    'total_price',
+    'subtotal_price',
+    'total_tax',
+    'total_discounts',
+    'tags',
+]
+
+# Order-level and customer-level columns, in a fixed order: the fields the report shows, the
+# order details above, and the keys used to join orders to customers. DataFrames are built with
+# exactly these columns, so pandas never has to discover them from the records.
+ORDER_COLUMNS = tuple(
+    [column[len('orders_'):] for column in REQUIRED_COLUMNS
+     if column.startswith('orders_') and not column.startswith('orders_item_')]
+    + ORDER_DETAIL_FIELDS
+    + ['customer_id']
+)
+CUSTOMER_COLUMNS = tuple(
+    ['id']
+    + [column[len('customers_'):] for column in REQUIRED_COLUMNS if column.startswith('customers_')]
+)
+
+# Flattened order fields kept; everything else is pruned while flattening
+ORDER_KEEP = frozenset(ORDER_COLUMNS)
+
+# Customer metafields copied onto the customer record; all other metafields are ignored
+WANTED_CUSTOMER_METAFIELDS = frozenset({'vat_number', 'shipping_address_id', 'billing_address_id', 'sales_manager'})
+
+# Every "a_b_" style prefix of the kept keys, i.e. the subtrees flatten_data must descend into
+@functools.lru_cache(maxsize=None)
+def keep_subtree_prefixes(keep_prefixes):
+    return frozenset(key[:i + 1] for key in keep_prefixes for i, char in enumerate(key) if char == '_')
+
+# Load credentials for Shopify and Google Sheets; the file is read once per worker
+@functools.lru_cache(maxsize=1)
 def load_credentials():
-    credentials_file_path = 'credentials.json'
-    with open(credentials_file_path, 'r') as file:
-        credentials = json.load(file)
-    return credentials
+    credentials_file_path = Path('credentials.json')
+    return orjson.loads(credentials_file_path.read_bytes())
 
-def flatten_data(y, shop_name):
+# Turn a GraphQL metafields connection into a {key: value} dict
+def extract_metafields(record):
+    metafields = record.get('metafields') or {}
+    return {edge['node']['key']: edge['node']['value'] for edge in metafields.get('edges', [])}
+
+# Flatten nested data into a single-level dict. When keep_prefixes is given, only those
+# flattened keys are kept and subtrees that can't lead to one of them are skipped entirely.
+# A GraphQL metafields connection is lifted to {key: value} columns instead of being flattened.
+def flatten_data(y, shop_name, keep_prefixes=None):
     out = {}
+    subtrees = keep_subtree_prefixes(keep_prefixes) if keep_prefixes is not None else None
+
+    metafields = {}
+    if isinstance(y, dict) and 'metafields' in y:
+        metafields = extract_metafields(y)
+        y = {k: v for k, v in y.items() if k != 'metafields'}
 
-    def flatten(x, name=''):
-        if isinstance(x, dict):
-            for a in x:
-                flatten(x[a], name + a + '_')
-        elif isinstance(x, list):
-            i = 0
-            for a in x:
-                flatten(a, name + str(i) + '_')
-                i += 1
+    # Walk the nested data with an explicit stack of (key prefix, children iterator) instead
+    # of recursing. Leaves are written as they are reached and a nested dict/list suspends its
+    # parent's iterator until it is exhausted, so columns keep their original order.
+    stack = [('', iter(y.items()) if isinstance(y, dict) else iter(enumerate(y)))]
+    while stack:
+        prefix, children = stack[-1]
+        for a, x in children:
+            if isinstance(x, dict):
+                if subtrees is None or f"{prefix}{a}_" in subtrees:
+                    stack.append((f"{prefix}{a}_", iter(x.items())))
+                    break
+            elif isinstance(x, list):
+                if subtrees is None or f"{prefix}{a}_" in subtrees:
+                    stack.append((f"{prefix}{a}_", iter(enumerate(x))))
+                    break
+            elif keep_prefixes is None or f"{prefix}{a}" in keep_prefixes:
+                out[f"{prefix}{a}"] = x
         else:
-            out[name[:-1]] = x
-    
-    flatten(y)
+            stack.pop()
 
-    # Process metafields if they exist
-    metafields = {}
-    for key in range(100):  # Assuming you may have up to 100 metafields; adjust as needed
-        metafield_key = out.get(f'metafields_edges_{key}_node_key')
-        metafield_value = out.get(f'metafields_edges_{key}_node_value')
-        if metafield_key:
-            metafields[metafield_key] = metafield_value
-    
-    # Update out dictionary with metafields and remove old metafield keys
-    out.update(metafields)
-    for key in range(100):  # Adjust the range based on your maximum number of metafields
-        out.pop(f'metafields_edges_{key}_node_key', None)
-        out.pop(f'metafields_edges_{key}_node_value', None)
+    # Add the metafields after the flattened fields
+    out.update((k, v) for k, v in metafields.items() if k and (keep_prefixes is None or k in keep_prefixes))
 
     out['shop_name'] = shop_name  # Add shop_name to the flattened output
     return out
 
 
 
-def process_order_data(orders, shop_name):
-    processed_orders = []
+# Customers have a known flat shape, so build the record directly instead of running the generic
+# flatten_data: the selected fields, shop_name, and the WANTED_CUSTOMER_METAFIELDS lifted to
+# top-level keys so the record maps straight onto CUSTOMER_COLUMNS
+def flatten_customer(customer, shop_name):
+    record = {
+        'id': customer['id'],
+        'email': customer.get('email'),
+        'firstName': customer.get('firstName'),
+        'lastName': customer.get('lastName'),
+        'shop_name': shop_name,
+    }
+    for edge in (customer.get('metafields') or {}).get('edges', []):
+        node = edge['node']
+        if node['key'] in WANTED_CUSTOMER_METAFIELDS:
+            record[node['key']] = node['value']
+    return record
+
+# Line item fields copied onto each order row, and the column names they are written to
+ITEM_COLUMNS = {'id': 'item_id', 'title': 'item_title', 'quantity': 'item_quantity', 'price': 'item_price'}
+
+# Expand a Series of line item lists into one item_* row per element, keeping the Series index.
+# An empty list explodes to a single row of missing values.
+def explode_line_items(line_items):
+    exploded = line_items.explode()
+    items = pd.DataFrame.from_records(
+        [item if isinstance(item, dict) else {} for item in exploded],
+        columns=list(ITEM_COLUMNS)
+    ).rename(columns=ITEM_COLUMNS)
+    items.index = exploded.index
+    return items
+
+# Low-cardinality columns stored as categories; everything else gets an Arrow-backed dtype
+CATEGORY_COLUMNS = [
+    'shop_name', 'item_type', 'fulfillment_status',
+    'shipping_address_country_code', 'shipping_address_province_code',
+    'billing_address_country_code', 'billing_address_province_code',
+]
+
+# Item quantities are downcast to the smallest integer type that holds them. Prices arrive as
+# decimal strings and are parsed to float64; float32 would show rounding noise once written to Sheets.
+INTEGER_COLUMNS = ['item_quantity']
+DECIMAL_COLUMNS = ['item_price']
+
+# Replace boxed Python objects with compact dtypes: categories for the repetitive columns,
+# numeric item columns, and pyarrow strings/ints/floats/bools for the rest
+def compact_dtypes(df):
+    categories = {column: 'category' for column in CATEGORY_COLUMNS if column in df.columns}
+    df = df.astype(categories).convert_dtypes(dtype_backend='pyarrow')
+    for column in INTEGER_COLUMNS:
+        if column in df.columns:
+            df[column] = pd.to_numeric(df[column], downcast='integer')
+    for column in DECIMAL_COLUMNS:
+        if column in df.columns:
+            df[column] = pd.to_numeric(df[column]).astype('double[pyarrow]')
+    return df
+
+# Yield each order flattened once, excluding line_items and fulfillments, and set those
+# lists aside so the item rows can be built from them afterwards
+def iter_flattened_orders(orders, shop_name, order_line_items, order_fulfillments):
     for order in orders:
-        # Flatten order data, excluding line_items and fulfillments
-        order_data = {k: v for k, v in order.items() if k not in ['line_items', 'fulfillments']}
-        order_data = flatten_data(order_data, shop_name)
-
-        # Process order line items
-        line_items = order.get('line_items', [])
-        if not line_items:
-            # If there are no line items, include the order with empty item details
-            processed_orders.append({
-                **order_data,
-                'item_type': 'order',
-                'item_id': None,
-                'item_title': None,
-                'item_quantity': None,
-                'item_price': None,
-                'fulfillment_id': None,
-                'fulfillment_status': None
-            })
-        else:
-            for item in line_items:
-                processed_orders.append({
-                    **order_data,
-                    'item_type': 'order',
-                    'item_id': item.get('id'),
-                    'item_title': item.get('title'),
-                    'item_quantity': item.get('quantity'),
-                    'item_price': item.get('price'),
-                    'fulfillment_id': None,
-                    'fulfillment_status': None
-                })
-        
-        # Process fulfillments and their line items
-        fulfillments = order.get('fulfillments', [])
-        for fulfillment in fulfillments:
-            fulfillment_id = fulfillment.get('id')
-            fulfillment_status = fulfillment.get('status')
-            fulfillment_items = fulfillment.get('line_items', [])
-            
-            if not fulfillment_items:
-                # If there are no fulfillment items, include the fulfillment with empty item details
-                processed_orders.append({
-                    **order_data,
-                    'item_type': 'fulfillment',
-                    'item_id': None,
-                    'item_title': None,
-                    'item_quantity': None,
-                    'item_price': None,
-                    'fulfillment_id': fulfillment_id,
-                    'fulfillment_status': fulfillment_status
-                })
-            else:
-                for item in fulfillment_items:
-                    processed_orders.append({
-                        **order_data,
-                        'item_type': 'fulfillment',
-                        'item_id': item.get('id'),
-                        'item_title': item.get('title'),
-                        'item_quantity': item.get('quantity'),
-                        'item_price': item.get('price'),
-                        'fulfillment_id': fulfillment_id,
-                        'fulfillment_status': fulfillment_status
-                    })
-    
-    return processed_orders
+        order_line_items.append(order.get('line_items') or [])
+        order_fulfillments.append(order.get('fulfillments') or [])
+        yield flatten_data({k: v for k, v in order.items() if k not in ['line_items', 'fulfillments']}, shop_name, ORDER_KEEP)
+
+# Concatenate the per-store frames for a combined tab. Stores have different categories
+# (shop_name at least), which pandas falls back to object for, so the category columns are
+# re-categorised on the combined frame.
+def concat_store_frames(frames, prefix):
+    df = pd.concat(frames, ignore_index=True)
+    categories = {column: 'category' for column in CATEGORY_COLUMNS if column in df.columns}
+    return df.astype(categories).add_prefix(prefix)
+
+def process_order_data(orders, shop_name):
+    # Stream the flattened orders straight into the DataFrame
+    order_line_items = []
+    order_fulfillments = []
+    df_orders = pd.DataFrame.from_records(iter_flattened_orders(orders, shop_name, order_line_items, order_fulfillments), columns=ORDER_COLUMNS)
+    if df_orders.empty:
+        return df_orders
+
+    # Order rows: one per line item, or a single empty row for orders without line items.
+    # The index is the order's position, used below to broadcast its columns.
+    df_items = explode_line_items(pd.Series(order_line_items, dtype=object))
+    df_items.insert(0, 'item_type', 'order')
+    df_items['fulfillment_id'] = None
+    df_items['fulfillment_status'] = None
+
+    # Fulfillment rows: one per fulfillment line item, or a single empty row for fulfillments
+    # without items. Orders without fulfillments contribute no rows.
+    fulfillments = pd.Series(order_fulfillments, dtype=object).explode().dropna()
+    df_fulfillments = pd.DataFrame({
+        'order_position': fulfillments.index,
+        'fulfillment_id': [fulfillment.get('id') for fulfillment in fulfillments],
+        'fulfillment_status': [fulfillment.get('status') for fulfillment in fulfillments],
+        'line_items': [fulfillment.get('line_items') or [] for fulfillment in fulfillments]
+    })
+    df_fulfillment_items = explode_line_items(df_fulfillments['line_items'])
+    df_fulfillment_items.insert(0, 'item_type', 'fulfillment')
+    fulfillment_of_row = df_fulfillments.loc[df_fulfillment_items.index]
+    df_fulfillment_items['fulfillment_id'] = fulfillment_of_row['fulfillment_id'].to_numpy()
+    df_fulfillment_items['fulfillment_status'] = fulfillment_of_row['fulfillment_status'].to_numpy()
+    df_fulfillment_items.index = fulfillment_of_row['order_position'].to_numpy()
+
+    # Keep each order's item rows ahead of its fulfillment rows, then broadcast the order
+    # columns onto every row. Item columns overwrite same-named order columns in place.
+    df_rows = pd.concat([df_items, df_fulfillment_items]).sort_index(kind='stable')
+    processed_orders = df_orders.take(df_rows.index).reset_index(drop=True)
+    for column in df_rows.columns:
+        processed_orders[column] = df_rows[column].to_numpy()
+
+    return compact_dtypes(processed_orders)
+
+# Retry throttled (429) and transient server errors, waiting for Shopify's Retry-After header.
+# GraphQL queries are sent as POST but are read-only, so they are safe to retry too.
+SHOPIFY_RETRY = Retry(
+    total=8,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    respect_retry_after_header=True,
+    allowed_methods=["GET", "POST"],
+    raise_on_status=False
+)
+
+# Mutations aren't safe to resend: after a 5xx or a lost response Shopify may already have
+# accepted one. Only retry when the request certainly didn't run, i.e. it was throttled (429)
+# or the connection failed before it was sent.
+SHOPIFY_MUTATION_RETRY = SHOPIFY_RETRY.new(status_forcelist=[429], read=0, other=0)
+
+# Pace requests against Shopify's leaky-bucket rate limits. Instead of sleeping a fixed second
+# before every page, each response reports how full the bucket is and the next request only
+# waits when there isn't enough headroom. Throttled (429) responses are still retried with
+# Retry-After by SHOPIFY_RETRY.
+class ShopifyRateLimiter:
+    def __init__(self, threshold=0.8, rest_restore_rate=2.0):
+        self.threshold = threshold  # REST bucket fill ratio above which requests slow down
+        self.rest_restore_rate = rest_restore_rate  # REST calls leaked per second (2 on standard plans)
+        self.delay = 0.0
+
+    # Sleep for the delay computed from the previous response, if any
+    def wait(self):
+        if self.delay > 0:
+            time.sleep(self.delay)
+        self.delay = 0.0
+
+    # REST: X-Shopify-Shop-Api-Call-Limit is "used/max"; once the bucket is nearly full,
+    # wait until it has drained back to half
+    def update_from_rest(self, response):
+        try:
+            used, limit = (int(part) for part in response.headers['X-Shopify-Shop-Api-Call-Limit'].split('/'))
+        except (KeyError, ValueError):
+            return
+        if limit and used / limit >= self.threshold:
+            self.delay = (used - 0.5 * limit) / self.rest_restore_rate
+
+    # GraphQL: extensions.cost.throttleStatus reports the available points and restore rate;
+    # wait until another query of the same cost fits in the bucket
+    def update_from_graphql(self, data):
+        cost = (data.get('extensions') or {}).get('cost')
+        if not cost:
+            return
+        throttle = cost['throttleStatus']
+        missing = cost['requestedQueryCost'] - throttle['currentlyAvailable']
+        self.delay = max(0.0, missing / throttle['restoreRate'])
+
+    # GraphQL signals throttling with HTTP 200 and a THROTTLED error instead of a 429, so the
+    # retry isn't handled by SHOPIFY_RETRY; wait for the bucket, and at least a second if the
+    # reply doesn't report its cost
+    def throttled(self, data):
+        self.update_from_graphql(data)
+        self.delay = max(self.delay, 1.0)
+
+# Create a Shopify HTTP session so every page reuses the same keep-alive connection
+def create_shopify_session(access_token, max_retries=SHOPIFY_RETRY):
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=max_retries))
+    session.headers.update({
+        "X-Shopify-Access-Token": access_token,
+        "Accept-Encoding": "gzip, deflate"
+    })
+    return session
 
 def fetch_all_customers_from_shopify(shop_name, access_token, api_version="2024-01"):
     url = f"https://{shop_name}.myshopify.com/admin/api/{api_version}/graphql.json"
-    headers = {
-        "X-Shopify-Access-Token": access_token,
-        "Content-Type": "application/json"
-    }
+    session = create_shopify_session(access_token)
+    session.headers["Content-Type"] = "application/json"
     
-    # Define the initial GraphQL query to fetch customers and metafields
+    # Define the GraphQL query to fetch customers and metafields; the page cursor is passed as a variable.
+    # Only the fields used downstream are selected; metafields are matched on key alone, so they are
+    # filtered against WANTED_CUSTOMER_METAFIELDS after fetching rather than with a namespaced keys: argument.
+    # Page sizes keep the requested cost under Shopify's 1000-point single-query limit: each customer
+    # costs 1 plus 2 + 10 for its metafields connection, so 50 customers request 2 + 50 * 13 = 652.
     query = '''
-    query {
-      customers(first: 250) {
+    query($cursor: String) {
+      customers(first: 50, after: $cursor) {
         edges {
           node {
             id
             email
             firstName
             lastName
-            metafields(first: 100) {
+            metafields(first: 10) {
               edges {
                 node {
-                  namespace
                   key
                   value
                 }
@@ -158,91 +424,558 @@ def fetch_all_customers_from_shopify(shop_name, access_token, api_version="2024-
     customers = []
     has_next_page = True
     end_cursor = None
+    rate_limiter = ShopifyRateLimiter()
     
-    while has_next_page:
-        # Add pagination to the query if necessary
-        paginated_query = query
-        if end_cursor:
-            paginated_query = query.replace('}', f', after: "{end_cursor}"}}')
-        
-        response = requests.post(url, headers=headers, json={'query': paginated_query})
+    with session:
+        while has_next_page:
+            rate_limiter.wait()
+
+            # The first page is fetched with a null cursor
+            response = session.post(url, data=orjson.dumps({'query': query, 'variables': {'cursor': end_cursor}}))
         
-        if response.status_code == 200:
-            data = response.json()
-            customer_edges = data['data']['customers']['edges']
-            customers.extend([edge['node'] for edge in customer_edges])
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+                errors = data.get('errors') or []
+                if any((error.get('extensions') or {}).get('code') == 'THROTTLED' for error in errors):
+                    # Retry the same cursor once the bucket has refilled
+                    logging.warning(f"Customers query throttled for {shop_name}, retrying")
+                    rate_limiter.throttled(data)
+                    continue
+                if not data.get('data'):
+                    # The query failed outright (e.g. access or cost errors). Keep the pages fetched
+                    # so far, but fail if there are none rather than reporting an empty store.
+                    logging.error(f"Error fetching customers: {errors}")
+                    if not customers:
+                        raise RuntimeError(f"Error fetching customers for {shop_name}: {errors}")
+                    break
+
+                customer_edges = data['data']['customers']['edges']
+                customers.extend([edge['node'] for edge in customer_edges])
             
-            # Check pagination
-            page_info = data['data']['customers']['pageInfo']
-            has_next_page = page_info['hasNextPage']
-            end_cursor = page_info.get('endCursor')
+                # Check pagination
+                page_info = data['data']['customers']['pageInfo']
+                has_next_page = page_info['hasNextPage']
+                end_cursor = page_info.get('endCursor')
             
-            time.sleep(1)  # Add sleep before making the request to avoid hitting rate limits
-        else:
-            response.raise_for_status()
+                rate_limiter.update_from_graphql(data)
+            else:
+                # Retries are exhausted or the error isn't retryable; keep the pages fetched so far
+                logging.error(f"Error fetching customers: {response.status_code} {response.text}")
+                break
     
     return customers
 
-def fetch_all_orders_from_shopify(shop_name, access_token, api_version="2024-01"):
+# Matches the rel="next" entry of a REST Link header and captures its URL
+NEXT_LINK_RE = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+# Stream all orders from the REST API one at a time. Each page is parsed incrementally with
+# ijson, so only the order being processed is held in memory rather than the whole page.
+def iter_orders_from_shopify(shop_name, access_token, api_version="2024-01"):
     url = f"https://{shop_name}.myshopify.com/admin/api/{api_version}/orders.json"
-    headers = {"X-Shopify-Access-Token": access_token}
-    orders = []
+    session = create_shopify_session(access_token)
+    total_orders = 0
     params = {"limit": 250, "status": "any"}  # Include all order statuses
+    rate_limiter = ShopifyRateLimiter()
 
-    while True:
-        time.sleep(1)  # Add sleep before making the request
-        logging.info(f"Fetching orders from URL: {url}")
-        response = requests.get(url, headers=headers, params=params)
-        logging.info(f"Response status code: {response.status_code}")
-        
-        if response.status_code == 200:
-            data = response.json()
-            new_orders = data.get('orders', [])
-            logging.info(f"Fetched {len(new_orders)} orders")
-            orders.extend(new_orders)
-
-            # Check if there's a next page
-            link_header = response.headers.get('Link')
-            if link_header and 'rel="next"' in link_header:
-                next_page_url = [link.split(';')[0].strip('<>') for link in link_header.split(',') if 'rel="next"' in link]
-                if next_page_url:
-                    url = next_page_url[0]  # Update URL for the next page
+    with session:
+        while True:
+            rate_limiter.wait()
+            logging.info(f"Fetching orders from URL: {url}")
+            with session.get(url, params=params, stream=True) as response:
+                logging.info(f"Response status code: {response.status_code}")
+                rate_limiter.update_from_rest(response)
+
+                if response.status_code != 200:
+                    # Retries are exhausted or the error isn't retryable; keep the pages fetched so far
+                    logging.error(f"Error fetching orders: {response.status_code} {response.text}")
+                    break
+
+                # Let urllib3 undo the gzip transfer encoding before ijson reads the body
+                response.raw.decode_content = True
+                page_orders = 0
+                for order in ijson.items(response.raw, 'orders.item', use_float=True):
+                    page_orders += 1
+                    yield order
+                logging.info(f"Fetched {page_orders} orders")
+                total_orders += page_orders
+
+                # Check if there's a next page
+                next_link = NEXT_LINK_RE.search(response.headers.get('Link', ''))
+                if next_link:
+                    url = next_link.group(1)  # Update URL for the next page
+                    # The next URL already carries page_info and limit; Shopify rejects
+                    # page_info requests that repeat other filters such as status
+                    params = None
                     logging.info(f"Next page URL: {url}")
                 else:
+                    logging.info("No more pages to fetch")
                     break
-            else:
-                logging.info("No more pages to fetch")
-                break
-        else:
-            logging.error(f"Error fetching orders: {response.text}")
+
+    logging.info(f"Total orders fetched: {total_orders}")
+
+# Mailing address selection shared by the order addresses and the customer default address
+BULK_ADDRESS_FIELDS = '''
+          firstName
+          lastName
+          address1
+          address2
+          city
+          province
+          country
+          zip
+          phone
+          company
+          name
+          countryCodeV2
+          provinceCode
+          latitude
+          longitude
+'''
+
+# Bulk query for every order with its customer, fulfillments and line items
+ORDERS_BULK_QUERY = '''
+{
+  orders {
+    edges {
+      node {
+        id
+        legacyResourceId
+        name
+        email
+        createdAt
+        processedAt
+        updatedAt
+        cancelledAt
+        cancelReason
+        estimatedTaxes
+        displayFulfillmentStatus
+        displayFinancialStatus
+        currencyCode
+        tags
+        totalPriceSet {
+          shopMoney {
+            amount
+          }
+        }
+        subtotalPriceSet {
+          shopMoney {
+            amount
+          }
+        }
+        totalTaxSet {
+          shopMoney {
+            amount
+          }
+        }
+        totalDiscountsSet {
+          shopMoney {
+            amount
+          }
+        }
+        shippingAddress {''' + BULK_ADDRESS_FIELDS + '''        }
+        billingAddress {''' + BULK_ADDRESS_FIELDS + '''        }
+        customer {
+          id
+          legacyResourceId
+          email
+          verifiedEmail
+          emailMarketingConsent {
+            marketingState
+          }
+          amountSpent {
+            currencyCode
+          }
+          defaultAddress {
+            id''' + BULK_ADDRESS_FIELDS + '''          }
+        }
+        fulfillments {
+          id
+          legacyResourceId
+          status
+        }
+        lineItems {
+          edges {
+            node {
+              id
+              title
+              quantity
+              originalUnitPriceSet {
+                shopMoney {
+                  amount
+                }
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+'''
+
+# Bulk query for every customer with the fields and metafields the paginated query selects
+CUSTOMERS_BULK_QUERY = '''
+{
+  customers {
+    edges {
+      node {
+        id
+        email
+        firstName
+        lastName
+        metafields {
+          edges {
+            node {
+              key
+              value
+            }
+          }
+        }
+      }
+    }
+  }
+}
+'''
+
+BULK_OPERATION_RUN_MUTATION = '''
+mutation bulkOperationRunQuery($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation {
+      id
+      status
+    }
+    userErrors {
+      field
+      message
+    }
+  }
+}
+'''
+
+CURRENT_BULK_OPERATION_QUERY = '''
+query {
+  currentBulkOperation {
+    id
+    status
+    errorCode
+    objectCount
+    url
+  }
+}
+'''
+
+# GraphQL field names that don't snake_case to their REST equivalents
+BULK_FIELD_RENAMES = {
+    'countryCodeV2': 'country_code',
+    'displayFulfillmentStatus': 'fulfillment_status',
+    'displayFinancialStatus': 'financial_status',
+    'marketingState': 'state',
+    'originalUnitPriceSet': 'price_set',
+    'currencyCode': 'currency'
+}
+# GraphQL returns these enums upper-cased where REST returns them lower-cased
+BULK_ENUM_FIELDS = {'cancel_reason', 'fulfillment_status', 'financial_status', 'status', 'state'}
+# Order amounts GraphQL returns as money sets, and the REST field holding the shop-currency amount
+BULK_MONEY_FIELDS = {
+    'total_price_set': 'total_price',
+    'subtotal_price_set': 'subtotal_price',
+    'total_tax_set': 'total_tax',
+    'total_discounts_set': 'total_discounts'
+}
+CAMEL_CASE_RE = re.compile(r'(?<=[a-z0-9])([A-Z])')
+
+# Convert a bulk operation node to the REST field names used by the orders tabs
+def to_rest_fields(node):
+    if isinstance(node, list):
+        return [to_rest_fields(value) for value in node]
+    if not isinstance(node, dict):
+        return node
+
+    out = {}
+    for key, value in node.items():
+        if key == 'legacyResourceId':
+            continue
+        name = BULK_FIELD_RENAMES.get(key) or CAMEL_CASE_RE.sub(r'_\1', key).lower()
+        value = to_rest_fields(value)
+        if name in BULK_ENUM_FIELDS and isinstance(value, str):
+            value = value.lower()
+        out[name] = value
+
+    # REST exposes the numeric id as 'id' and the GraphQL gid as 'admin_graphql_api_id'
+    if node.get('legacyResourceId'):
+        out['id'] = int(node['legacyResourceId'])
+        out['admin_graphql_api_id'] = node['id']
+    elif isinstance(node.get('id'), str) and node['id'].startswith('gid://'):
+        # Objects without legacyResourceId (line items, mailing addresses) only carry the gid. Its
+        # last path segment, before any ?model_name=... query, is the numeric REST id.
+        out['id'] = int(node['id'].split('?', 1)[0].rsplit('/', 1)[-1])
+    return out
+
+# Shopify runs one bulk query operation per shop at a time, so bulk fetches against the same
+# shop's endpoint (orders and customers) take turns submitting and polling
+BULK_OPERATION_LOCKS = {}
+
+# Submit a bulk query and wait for Shopify to finish running it; returns the JSONL result URL.
+# Bodies are pre-encoded with orjson, so the session must send Content-Type: application/json.
+def run_bulk_operation(session, url, bulk_query, poll_interval=5):
+    with BULK_OPERATION_LOCKS.setdefault(url, threading.Lock()):
+        # Submit the mutation on its own session that doesn't resend it after a server error
+        with create_shopify_session(session.headers["X-Shopify-Access-Token"], SHOPIFY_MUTATION_RETRY) as mutation_session:
+            mutation_session.headers["Content-Type"] = "application/json"
+            response = mutation_session.post(url, data=orjson.dumps({'query': BULK_OPERATION_RUN_MUTATION, 'variables': {'query': bulk_query}}))
+        response.raise_for_status()
+        result = orjson.loads(response.content)['data']['bulkOperationRunQuery']
+        if result['userErrors']:
+            logging.error(f"Bulk operation rejected: {result['userErrors']}")
+            raise RuntimeError(f"Bulk operation rejected: {result['userErrors']}")
+
+        while True:
+            time.sleep(poll_interval)
+            response = session.post(url, data=orjson.dumps({'query': CURRENT_BULK_OPERATION_QUERY}))
             response.raise_for_status()
+            operation = orjson.loads(response.content)['data']['currentBulkOperation']
+            logging.info(f"Bulk operation {operation['id']} status: {operation['status']}")
 
-    logging.info(f"Total orders fetched: {len(orders)}")
-    return orders
+            if operation['status'] == 'COMPLETED':
+                # url is null when the query matched no objects
+                return operation.get('url')
+            if operation['status'] in ('FAILED', 'CANCELED', 'EXPIRED'):
+                logging.error(f"Bulk operation {operation['id']} ended with {operation['status']}: {operation.get('errorCode')}")
+                raise RuntimeError(f"Bulk operation ended with status {operation['status']}")
 
-# Upload customer data to a specific tab in Google Sheets
-def upload_to_google_sheets(sheet_name, tab_name, data):
-    # Load Google Sheets credentials from the same JSON file
-    credentials = load_credentials()
-    google_credentials = credentials.get('Google', {})
-    
-    # Create a credentials object for gspread
-    client = gspread.service_account_from_dict(google_credentials)
-    
-    # Open the Google Sheet
-    spreadsheet = client.open(sheet_name)
-    
-    # Select or create the tab/sheet
+# Stream the JSONL file produced by a bulk operation, one parsed object per line
+def iter_bulk_results(result_url):
+    if not result_url:
+        return
+    # The result URL is pre-signed storage, so it must not receive the Shopify token
+    with requests.get(result_url, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                yield orjson.loads(line)
+
+# Stream all orders from a single GraphQL bulk operation instead of paging the REST API.
+# Rows are rebuilt into the REST order shape so process_order_data handles them unchanged;
+# fulfillment line items aren't available in bulk queries, so fulfillments carry no items.
+def iter_orders_bulk(shop_name, access_token, api_version="2024-01"):
+    url = f"https://{shop_name}.myshopify.com/admin/api/{api_version}/graphql.json"
+    session = create_shopify_session(access_token)
+    session.headers["Content-Type"] = "application/json"
+
+    with session:
+        logging.info(f"Starting orders bulk operation for store: {shop_name}")
+        result_url = run_bulk_operation(session, url, ORDERS_BULK_QUERY)
+
+    # Child lines follow their parent in the JSONL file, so an order is complete
+    # as soon as the next order starts. A line item that doesn't belong to the current
+    # order breaks that assumption, so fail rather than attach it to the wrong order.
+    total_orders = 0
+    order = None
+    order_gid = None
+    for row in iter_bulk_results(result_url):
+        if '__parentId' not in row:
+            if order is not None:
+                yield order
+            order_gid = row['id']
+            order = to_rest_fields(row)
+            for set_name, field in BULK_MONEY_FIELDS.items():
+                order[field] = (order.pop(set_name, None) or {}).get('shop_money', {}).get('amount')
+            # REST returns tags as one comma-separated string
+            if isinstance(order.get('tags'), list):
+                order['tags'] = ', '.join(order['tags'])
+            # REST's customer currency is the currency the customer pays in
+            if order.get('customer'):
+                order['customer']['currency'] = (order['customer'].pop('amount_spent', None) or {}).get('currency')
+            order['line_items'] = []
+            total_orders += 1
+        else:
+            # The only child connection in ORDERS_BULK_QUERY is lineItems
+            parent_gid = row.pop('__parentId')
+            if parent_gid != order_gid:
+                logging.error(f"Bulk line item {row.get('id')} for {parent_gid} arrived outside its order (current order: {order_gid})")
+                raise RuntimeError(f"Bulk line item for {parent_gid} arrived outside its order")
+            item = to_rest_fields(row)
+            item['price'] = (item.pop('price_set', None) or {}).get('shop_money', {}).get('amount')
+            order['line_items'].append(item)
+    if order is not None:
+        yield order
+
+    logging.info(f"Total orders fetched: {total_orders}")
+
+# Fetch all customers with a single GraphQL bulk operation instead of paging the customers query.
+# Metafield lines are folded back into their customer's metafields connection, so customers have
+# the same shape as fetch_all_customers_from_shopify returns.
+def fetch_all_customers_bulk(shop_name, access_token, api_version="2024-01"):
+    url = f"https://{shop_name}.myshopify.com/admin/api/{api_version}/graphql.json"
+    session = create_shopify_session(access_token)
+    session.headers["Content-Type"] = "application/json"
+
+    with session:
+        logging.info(f"Starting customers bulk operation for store: {shop_name}")
+        result_url = run_bulk_operation(session, url, CUSTOMERS_BULK_QUERY)
+
+    # The only child connection in CUSTOMERS_BULK_QUERY is metafields. Customers are all held
+    # in memory anyway, so metafields are grouped by their parent's gid and attached afterwards
+    # rather than relying on the order of the lines.
+    customers = []
+    metafields_by_gid = {}
+    for row in iter_bulk_results(result_url):
+        if '__parentId' not in row:
+            customers.append(row)
+        else:
+            metafields_by_gid.setdefault(row['__parentId'], []).append({'node': {'key': row['key'], 'value': row['value']}})
+
+    for customer in customers:
+        customer['metafields'] = {'edges': metafields_by_gid.get(customer['id'], [])}
+
+    logging.info(f"Total customers fetched: {len(customers)}")
+    return customers
+
+# Run an iterator on a background thread and yield its items through a bounded queue, so the
+# producer's network I/O overlaps with whatever the consumer does with each item. Errors raised
+# by the producer are re-raised to the consumer.
+def prefetch(iterable, maxsize=250):
+    items = queue.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+    done = object()
+
+    # Stop blocking on a full queue once the consumer has gone away
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                items.put(entry, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    break
+            else:
+                put((done, None))
+        except Exception as error:
+            put((done, error))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    threading.Thread(target=produce, daemon=True).start()
     try:
-        sheet = spreadsheet.worksheet(tab_name)  # Try to select the existing sheet
-    except gspread.exceptions.WorksheetNotFound:
-        sheet = spreadsheet.add_worksheet(title=tab_name, rows="1000", cols="26")  # Create a new sheet if not found
-    
-    # Clear the existing tab data
-    sheet.clear()
-    
-    # Upload data
-    gd.set_with_dataframe(worksheet=sheet, dataframe=data, include_index=False, include_column_header=True, resize=True)
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+
+# Flatten a store's orders into its orders DataFrame while they stream in, so each raw
+# order can be discarded as soon as it has been processed. The next page downloads
+# on a background thread while the current one is being flattened.
+def fetch_and_process_orders(iter_orders, shop_name, access_token, api_version):
+    return process_order_data(prefetch(iter_orders(shop_name, access_token, api_version)), shop_name)
+
+# Let Sheets parse numbers and dates in the uploaded strings, as set_with_dataframe did
+SHEETS_VALUE_INPUT_OPTION = "USER_ENTERED"
+
+# Authorize gspread once per worker; the client refreshes its OAuth token by itself
+@functools.lru_cache(maxsize=1)
+def get_gspread_client():
+    # Load Google Sheets credentials from the same JSON file
+    google_credentials = load_credentials().get('Google', {})
+    return gspread.service_account_from_dict(google_credentials)
+
+# Open a Google Sheet by name once and reuse the handle for later uploads
+@functools.lru_cache(maxsize=None)
+def open_spreadsheet(sheet_name):
+    return get_gspread_client().open(sheet_name)
+
+# Upload tabs on a background thread as they become ready. The spreadsheet is opened as soon as
+# the uploader starts, tabs queued while an upload is in flight are coalesced into the next batch,
+# and batches go out one at a time so the spreadsheet is never written to concurrently. Leaving the
+# with block uploads whatever is still queued and re-raises the first upload error.
+class SheetsUploader:
+    def __init__(self, sheet_name):
+        self.sheet_name = sheet_name
+        self.tabs = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.tabs.put(None)
+        self.thread.join()
+        if exc_type is None and self.error is not None:
+            raise self.error
+
+    def put(self, tab_name, data):
+        self.tabs.put((tab_name, data))
+
+    def run(self):
+        spreadsheet = None
+        try:
+            spreadsheet = open_spreadsheet(self.sheet_name)
+        except Exception as error:
+            self.error = error
+
+        finished = False
+        while not finished:
+            # Block for the next tab, then take everything else that is already waiting
+            batch = [self.tabs.get()]
+            while True:
+                try:
+                    batch.append(self.tabs.get_nowait())
+                except queue.Empty:
+                    break
+            finished = None in batch
+            batch = [entry for entry in batch if entry is not None]
+
+            # After a failure keep draining the queue so the with block can exit
+            if batch and self.error is None:
+                try:
+                    upload_to_google_sheets(spreadsheet, batch)
+                except Exception as error:
+                    self.error = error
+
+# Upload DataFrames to their tabs of an opened spreadsheet with at most two requests: one batchUpdate
+# that creates or resizes tabs as needed, and one values batchUpdate carrying all of the data
+def upload_to_google_sheets(spreadsheet, uploads):
+    existing_sheets = {sheet.title: sheet for sheet in spreadsheet.worksheets()}
+
+    sheet_requests = []
+    value_ranges = []
+    for tab_name, data in uploads:
+        # Convert the DataFrame to rows once; missing values become empty cells
+        values = [data.columns.tolist()] + data.astype(object).where(data.notna(), "").values.tolist()
+
+        # Create missing tabs at exactly the size of the data, and only resize existing
+        # tabs whose grid doesn't already match it
+        rows_needed = len(values)
+        cols_needed = max(len(data.columns), 1)
+        grid = {"rowCount": rows_needed, "columnCount": cols_needed}
+        sheet = existing_sheets.get(tab_name)
+        if sheet is None:
+            sheet_requests.append({"addSheet": {"properties": {"title": tab_name, "gridProperties": grid}}})
+        elif (sheet.row_count, sheet.col_count) != (rows_needed, cols_needed):
+            sheet_requests.append({"updateSheetProperties": {
+                "properties": {"sheetId": sheet.id, "gridProperties": grid},
+                "fields": "gridProperties(rowCount,columnCount)"
+            }})
+
+        value_ranges.append({"range": absolute_range_name(tab_name, "A1"), "values": values})
+
+    # Every cell of the resized grids is overwritten, so the tabs don't need clearing first
+    if sheet_requests:
+        spreadsheet.batch_update({"requests": sheet_requests})
+    spreadsheet.values_batch_update({"valueInputOption": SHEETS_VALUE_INPUT_OPTION, "data": value_ranges})
 
 
 def process_stores():
@@ -251,9 +984,9 @@ def process_stores():
         credentials = load_credentials()
         results = []
 
-        # Initialize lists to accumulate all customers and orders
-        all_customers = []
-        all_orders = []
+        # Per-store DataFrames, concatenated once at the end for the combined tabs
+        store_dfs_customers = []
+        store_dfs_orders = []
 
         # List of stores and corresponding Google Sheets tabs
         stores = {
@@ -264,193 +997,124 @@ def process_stores():
         # Google Sheet name
         google_sheet_name = "Reporting_Shopify"
 
+        # Collect the stores that have credentials before fetching anything
+        store_jobs = []
         for store, (tab_customers, tab_orders) in stores.items():
             logging.info(f"Processing store: {store}")
             shopify_credentials = credentials.get(store, {})
             shop_name = shopify_credentials.get("SHOP_NAME")
             access_token = shopify_credentials.get("API_ACCESS_TOKEN")
             api_version = shopify_credentials.get("API_VERSION", "2024-01")
+            # Large stores can opt into fetching customers and orders with GraphQL bulk operations
+            use_bulk = shopify_credentials.get("BULK_OPERATIONS", False)
 
             if shop_name and access_token:
                 logging.info(f"Credentials found for store: {shop_name}")
-                
-                logging.info(f"Fetching customers for store: {shop_name}")
-                customers = fetch_all_customers_from_shopify(shop_name, access_token, api_version)
-                
-                logging.info(f"Fetching orders for store: {shop_name}")
-                orders = fetch_all_orders_from_shopify(shop_name, access_token, api_version)
-
-                if customers:
-                    logging.info(f"Processing {len(customers)} customers for {shop_name}")
-                    flattened_customers = [flatten_data(customer, shop_name) for customer in customers]
-                    df_customers = pd.DataFrame(flattened_customers)
-                    
-                    # Ensure 'id' column is present
-                    if 'id' in df_customers.columns:
-                        df_customers.rename(columns={'id': 'customers_id'}, inplace=True)
-                    else:
-                        logging.error(f"'id' column is missing in customer data for {shop_name}")
-                        raise KeyError("'id' column is missing in customer data")
-
-                    upload_to_google_sheets(google_sheet_name, tab_customers, df_customers)
-                    all_customers.extend(flattened_customers)
-                    results.append(f"Flattened customers data for {shop_name} has been saved to Google Sheets tab: {tab_customers}.")
-                else:
-                    logging.warning(f"No customer data found for store: {shop_name}")
-                    results.append(f"No customer data found for store: {shop_name}")
-
-                if orders:
-                    logging.info(f"Processing {len(orders)} orders for {shop_name}")
-                    processed_orders = process_order_data(orders, shop_name)
-                    df_orders = pd.DataFrame(processed_orders)
-                    
-                    # Ensure 'customer_id' column is present
-                    if 'customer_id' in df_orders.columns:
-                        df_orders.rename(columns={'customer_id': 'orders_customer_id'}, inplace=True)
-                    else:
-                        logging.error(f"'customer_id' column is missing in orders data for {shop_name}")
-                        raise KeyError("'customer_id' column is missing in orders data")
-
-                    upload_to_google_sheets(google_sheet_name, tab_orders, df_orders)
-                    all_orders.extend(processed_orders)
-                    results.append(f"Processed orders data for {shop_name} has been saved to Google Sheets tab: {tab_orders}.")
-                else:
-                    logging.warning(f"No orders data found for store: {shop_name}")
-                    results.append(f"No orders data found for store: {shop_name}")
+                store_jobs.append((store, shop_name, access_token, api_version, use_bulk, (tab_customers, tab_orders)))
             else:
                 logging.error(f"Missing credentials for store: {store}")
                 results.append(f"Missing credentials for store: {store}")
 
-        # Convert lists of dictionaries to DataFrames
-        if all_customers:
-            df_all_customers = pd.DataFrame(all_customers).add_prefix('customers_')
-        
-        if all_orders:
-            df_all_orders = pd.DataFrame(all_orders).add_prefix('orders_')
-
-        # Debugging: Print column names
-        logging.debug(f"Customer DataFrame columns: {df_all_customers.columns.tolist()}")
-        logging.debug(f"Orders DataFrame columns: {df_all_orders.columns.tolist()}")
-
-        # Ensure the merge keys are strings and numeric IDs
-        if all_customers and all_orders:
-            if 'customers_id' in df_all_customers.columns and 'orders_customer_admin_graphql_api_id' in df_all_orders.columns:
-                df_all_customers['customers_id'] = df_all_customers['customers_id'].astype(str)
-                df_all_orders['orders_customer_admin_graphql_api_id'] = df_all_orders['orders_customer_admin_graphql_api_id'].astype(str)
+        # Shopify fetches are network-bound and independent, so run them concurrently. Each store's
+        # tabs are built as soon as its own fetches finish and handed to the uploader, so Google
+        # Sheets uploads overlap with the stores that are still being fetched.
+        with SheetsUploader(google_sheet_name) as uploader:
+            with ThreadPoolExecutor(max_workers=6) as executor:
+                store_futures = {}
+                for store, shop_name, access_token, api_version, use_bulk, _ in store_jobs:
+                    logging.info(f"Fetching customers for store: {shop_name}")
+                    fetch_customers = fetch_all_customers_bulk if use_bulk else fetch_all_customers_from_shopify
+                    customers_future = executor.submit(fetch_customers, shop_name, access_token, api_version)
+                    logging.info(f"Fetching orders for store: {shop_name}")
+                    iter_orders = iter_orders_bulk if use_bulk else iter_orders_from_shopify
+                    orders_future = executor.submit(fetch_and_process_orders, iter_orders, shop_name, access_token, api_version)
+                    store_futures[store] = (customers_future, orders_future)
 
-                # Merge the DataFrames on the customer ID, ensuring all orders are retained and customer details are added
-                df_combined = pd.merge(df_all_orders, df_all_customers, left_on='orders_customer_admin_graphql_api_id', right_on='customers_id', how='left')
+                # Take the stores in order so the results and combined tabs keep a stable order
+                for store, shop_name, access_token, api_version, use_bulk, (tab_customers, tab_orders) in store_jobs:
+                    customers_future, orders_future = store_futures[store]
+                    customers = customers_future.result()
+                    df_orders = orders_future.result()
 
-                # Select only the columns you want to keep
-                required_columns = [
-    # Orders Details
-    'orders_id',
-    'orders_cancel_reason',
-    'orders_cancelled_at',
-    'orders_estimated_taxes',
-    'orders_fulfillment_status',
-    'orders_updated_at',
-    'orders_item_type',
-    'orders_item_id',
-    'orders_item_title',
-    'orders_item_quantity',
-    'orders_item_price',
+                    if customers:
+                        logging.info(f"Processing {len(customers)} customers for {shop_name}")
+                        flattened_customers = [flatten_customer(customer, shop_name) for customer in customers]
+                        df_customers = compact_dtypes(pd.DataFrame.from_records(flattened_customers, columns=CUSTOMER_COLUMNS))
+                
+                        # Ensure 'id' column is present
+                        if 'id' in df_customers.columns:
+                            df_customers_tab = df_customers.rename(columns={'id': 'customers_id'})
+                        else:
+                            logging.error(f"'id' column is missing in customer data for {shop_name}")
+                            raise KeyError("'id' column is missing in customer data")
 
-    # Orders Shipping Address
-    'orders_shipping_address_first_name',
-    'orders_shipping_address_last_name',
-    'orders_shipping_address_address1',
-    'orders_shipping_address_address2',
-    'orders_shipping_address_city',
-    'orders_shipping_address_province',
-    'orders_shipping_address_country',
-    'orders_shipping_address_zip',
-    'orders_shipping_address_phone',
-    'orders_shipping_address_company',
-    'orders_shipping_address_name',
-    'orders_shipping_address_country_code',
-    'orders_shipping_address_province_code',
-    'orders_shipping_address_latitude',
-    'orders_shipping_address_longitude',
+                        uploader.put(tab_customers, df_customers_tab)
+                        store_dfs_customers.append(df_customers)
+                        results.append(f"Flattened customers data for {shop_name} has been saved to Google Sheets tab: {tab_customers}.")
+                    else:
+                        logging.warning(f"No customer data found for store: {shop_name}")
+                        results.append(f"No customer data found for store: {shop_name}")
 
-    # Orders Billing Address
-    'orders_billing_address_first_name',
-    'orders_billing_address_last_name',
-    'orders_billing_address_address1',
-    'orders_billing_address_address2',
-    'orders_billing_address_city',
-    'orders_billing_address_province',
-    'orders_billing_address_country',
-    'orders_billing_address_zip',
-    'orders_billing_address_phone',
-    'orders_billing_address_company',
-    'orders_billing_address_name',
-    'orders_billing_address_country_code',
-    'orders_billing_address_province_code',
-    'orders_billing_address_latitude',
-    'orders_billing_address_longitude',
+                    if not df_orders.empty:
+                        logging.info(f"Processing {len(df_orders)} order rows for {shop_name}")
+                
+                        # Ensure 'customer_id' column is present
+                        if 'customer_id' in df_orders.columns:
+                            df_orders_tab = df_orders.rename(columns={'customer_id': 'orders_customer_id'})
+                        else:
+                            logging.error(f"'customer_id' column is missing in orders data for {shop_name}")
+                            raise KeyError("'customer_id' column is missing in orders data")
 
-    # Orders Customer Default Address
-    'orders_customer_default_address_id',
-    'orders_customer_default_address_customer_id',
-    'orders_customer_default_address_first_name',
-    'orders_customer_default_address_last_name',
-    'orders_customer_default_address_company',
-    'orders_customer_default_address_address1',
-    'orders_customer_default_address_address2',
-    'orders_customer_default_address_city',
-    'orders_customer_default_address_province',
-    'orders_customer_default_address_country',
-    'orders_customer_default_address_zip',
-    'orders_customer_default_address_phone',
-    'orders_customer_default_address_name',
-    'orders_customer_default_address_province_code',
-    'orders_customer_default_address_country_code',
-    'orders_customer_default_address_country_name',
-    'orders_customer_default_address_default',
+                        uploader.put(tab_orders, df_orders_tab)
+                        store_dfs_orders.append(df_orders)
+                        results.append(f"Processed orders data for {shop_name} has been saved to Google Sheets tab: {tab_orders}.")
+                    else:
+                        logging.warning(f"No orders data found for store: {shop_name}")
+                        results.append(f"No orders data found for store: {shop_name}")
 
-    # Orders Refunds
-    'orders_refunds_0_transactions_0_created_at',
-    'orders_refunds_0_refund_line_items_0_line_item_fulfillment_service',
+            # Concatenate the per-store DataFrames instead of rebuilding them from records
+            if store_dfs_customers:
+                df_all_customers = concat_store_frames(store_dfs_customers, 'customers_')
+                logging.debug(f"Customer DataFrame columns: {df_all_customers.columns.tolist()}")
 
-    # Customers
-    'customers_email',
-    'customers_firstName',
-    'customers_lastName',
-    'customers_shop_name',
-    'customers_vat_number',
-    'customers_shipping_address_id',
-    'customers_billing_address_id',
-    'customers_sales_manager',
+            if store_dfs_orders:
+                df_all_orders = concat_store_frames(store_dfs_orders, 'orders_')
+                logging.debug(f"Orders DataFrame columns: {df_all_orders.columns.tolist()}")
 
-    # Orders Shop
-    'orders_shop_name',
+            # Join orders to customers on the numeric customer ID
+            if store_dfs_customers and store_dfs_orders:
+                if 'customers_id' in df_all_customers.columns and 'orders_customer_id' in df_all_orders.columns:
+                    # Customers carry the GraphQL gid (gid://shopify/Customer/<id>) while orders carry
+                    # the numeric ID; key both sides on Int64 so the join hashes integers, not strings
+                    customer_keys = pd.to_numeric(df_all_customers['customers_id'].astype(str).str.rsplit('/', n=1).str[-1], errors='coerce').astype('Int64')
+                    order_keys = pd.to_numeric(df_all_orders['orders_customer_id'], errors='coerce').astype('Int64')
 
-    # Orders Customer
-    'orders_customer_verified_email',
-    'orders_customer_email_marketing_consent_state',
-    'orders_customer_currency',
-]
+                    # Narrow both sides to the report columns before joining so unused columns aren't copied,
+                    # then index the customers by their key, ensuring all orders are retained and customer details are added
+                    df_orders_report = df_all_orders.reindex(columns=ORDER_REPORT_COLUMNS).assign(customer_key=order_keys)
+                    df_customers_by_id = df_all_customers.reindex(columns=CUSTOMER_REPORT_COLUMNS).set_index(pd.Index(customer_keys, name='customer_key'))
+                    df_combined = df_orders_report.join(df_customers_by_id, on='customer_key', how='left')
 
+                    # Keep only the required columns; fields a store doesn't return (e.g. refunds
+                    # from bulk-fetched orders) are left blank instead of failing the merge
+                    df_combined = df_combined.reindex(columns=REQUIRED_COLUMNS)
 
-                # Keep only the required columns
-                df_combined = df_combined[required_columns]
+                    # Upload the merged data to Google Sheets
+                    uploader.put("Combined_Customers_Orders", df_combined)
+                    results.append("Merged customer and orders data has been saved to Google Sheets tab: Combined_Customers_Orders.")
+                else:
+                    logging.error("One or both of the required columns are missing for merging")
+                    raise KeyError("One or both of the required columns are missing for merging")
 
-                # Upload the merged data to Google Sheets
-                upload_to_google_sheets(google_sheet_name, "Combined_Customers_Orders", df_combined)
-                results.append("Merged customer and orders data has been saved to Google Sheets tab: Combined_Customers_Orders.")
-            else:
-                logging.error("One or both of the required columns are missing for merging")
-                raise KeyError("One or both of the required columns are missing for merging")
+            # Upload individual datasets to Google Sheets if necessary
+            if store_dfs_customers:
+                uploader.put("Customers_all", df_all_customers)
+                results.append("Combined customer data has been saved to Google Sheets tab: Customers_all.")
 
-        # Upload individual datasets to Google Sheets if necessary
-        if all_customers:
-            upload_to_google_sheets(google_sheet_name, "Customers_all", df_all_customers)
-            results.append("Combined customer data has been saved to Google Sheets tab: Customers_all.")
+            if store_dfs_orders:
+                uploader.put("Orders_all", df_all_orders)
+                results.append("Combined orders data has been saved to Google Sheets tab: Orders_all.")
 
-        if all_orders:
-            upload_to_google_sheets(google_sheet_name, "Orders_all", df_all_orders)
-            results.append("Combined orders data has been saved to Google Sheets tab: Orders_all.")
         result_message = "\n".join(results)
         logging.info(f"Process completed. Results: {result_message}")
         return result_message